@@ -1,43 +1,92 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, status
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr, Field
-from typing import Optional, List
+from typing import Optional, List, Tuple
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
+import os
 from motor.motor_asyncio import AsyncIOMotorClient
-from passlib.context import CryptContext
+import redis.asyncio as aioredis
+import bcrypt
 import jwt
+import orjson
+import numpy as np
+from PIL import Image
 import qrcode
+import qrcode.util
+from numba import njit
+import asyncio
+import functools
+import multiprocessing
+import hashlib
 import io
 import base64
-import os
-from bson import ObjectId
+import time
+import uuid
+from bson import Binary, ObjectId
+from pymongo.errors import DuplicateKeyError
+from pymongo.write_concern import WriteConcern
 
 # Environment variables
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "assignmentdb")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
 JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-key-change-in-production")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
+JWT_SIGNING_KEY = JWT_SECRET.encode()
+TOKEN_CACHE_SIZE = 4096
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+# Share the CPUs between server workers so each one's bcrypt pool doesn't oversubscribe them
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_TIMEOUT_SECONDS = float(os.getenv("REDIS_TIMEOUT_SECONDS", "0.5"))
+QR_CACHE_TTL_SECONDS = 3600
+HEALTH_PING_INTERVAL_SECONDS = 1
+HEALTH_STALE_AFTER_SECONDS = 3 * HEALTH_PING_INTERVAL_SECONDS
+QR_BOX_SIZE = 10
+QR_BORDER = 5
 
 # Initialize FastAPI
 app = FastAPI(
     title="User/Auth/QR Microservice",
     description="User management, authentication, and QR code generation service",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # MongoDB connection
-client = AsyncIOMotorClient(MONGO_URI)
+client = AsyncIOMotorClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE)
 db = client[DB_NAME]
 users_collection = db["users"]
+qr_codes_collection = db["qr_codes"]
+
+# QR data is derivable, so its writes skip waiting for the journal
+QR_WRITE_CONCERN = WriteConcern(w=1, j=False)
+qr_codes_qr_writes = qr_codes_collection.with_options(write_concern=QR_WRITE_CONCERN)
+users_qr_writes = users_collection.with_options(write_concern=QR_WRITE_CONCERN)
+
+# Fields never needed when reading users on behalf of a request
+# (qr_code is only present on documents created before QR images moved to qr_codes)
+USER_PROJECTION = {"password": 0, "qr_code": 0}
+# Login needs the password hash plus the fields cached for the new session
+LOGIN_PROJECTION = {"qr_code": 0}
 
-# Password hashing (with truncation to avoid bcrypt 72-byte limit)
-pwd_context = CryptContext(
-    schemes=["bcrypt"],
-    deprecated="auto",
-    bcrypt__truncate_error=True
+# Redis connection (authenticated user cache keyed by token jti)
+# Short timeouts so an unreachable Redis degrades to MongoDB lookups quickly
+redis = aioredis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=REDIS_TIMEOUT_SECONDS,
+    socket_timeout=REDIS_TIMEOUT_SECONDS
 )
 
+# Process pool for bcrypt, created on startup (None falls back to the default thread pool)
+bcrypt_pool: Optional[ProcessPoolExecutor] = None
+
 # Security
 security = HTTPBearer()
 
@@ -60,7 +109,6 @@ class UserResponse(BaseModel):
     full_name: Optional[str]
     role: str
     created_at: datetime
-    qr_code: Optional[str] = None
 
 class Token(BaseModel):
     access_token: str
@@ -72,110 +120,387 @@ class QRCodeResponse(BaseModel):
     data: str
 
 # Helper functions
-def hash_password(password: str) -> str:
+def create_bcrypt_pool() -> ProcessPoolExecutor:
+    """Create the bcrypt process pool"""
+    # forkserver: don't fork a process that already runs Motor's executor threads
+    return ProcessPoolExecutor(
+        max_workers=BCRYPT_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver")
+    )
+
+async def run_bcrypt(func, *args):
+    """Run a bcrypt call in the process pool, replacing the pool once if a worker died"""
+    global bcrypt_pool
+    loop = asyncio.get_running_loop()
+    pool = bcrypt_pool
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # Concurrent requests may see the same broken pool; only replace it once
+        if bcrypt_pool is pool:
+            print("⚠️  bcrypt process pool broken, restarting it")
+            bcrypt_pool = create_bcrypt_pool()
+            pool.shutdown(wait=False)
+        return await loop.run_in_executor(bcrypt_pool, func, *args)
+
+async def hash_password(password: str) -> str:
     # Truncate password to 72 bytes for bcrypt compatibility
-    if len(password.encode('utf-8')) > 72:
-        password = password[:72]
-    return pwd_context.hash(password)
+    password_bytes = password.encode('utf-8')[:72]
+    # bcrypt is CPU-bound; run it off the event loop on another core
+    hashed = await run_bcrypt(bcrypt.hashpw, password_bytes, bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    return hashed.decode()
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
     # Truncate password to 72 bytes for bcrypt compatibility
-    if len(plain_password.encode('utf-8')) > 72:
-        plain_password = plain_password[:72]
-    return pwd_context.verify(plain_password, hashed_password)
+    password_bytes = plain_password.encode('utf-8')[:72]
+    return await run_bcrypt(bcrypt.checkpw, password_bytes, hashed_password.encode())
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS)
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    to_encode.setdefault("jti", uuid.uuid4().hex)
+    return jwt.encode(to_encode, JWT_SIGNING_KEY, algorithm=JWT_ALGORITHM)
+
+# Verified token payloads, most recently used last
+_token_cache: "OrderedDict[str, dict]" = OrderedDict()
+
+def decode_access_token(token: str) -> dict:
+    """Decode and verify a token, reusing the result for tokens seen recently"""
+    payload = _token_cache.get(token)
+    if payload is not None:
+        if payload["exp"] <= time.time():
+            del _token_cache[token]
+            raise jwt.ExpiredSignatureError("Signature has expired")
+        _token_cache.move_to_end(token)
+        return payload
+    
+    payload = jwt.decode(
+        token,
+        JWT_SIGNING_KEY,
+        algorithms=[JWT_ALGORITHM],
+        options={"require": ["exp", "sub"]}
+    )
+    # The subject must be a user ID; reject it here so it surfaces as a 401
+    if not isinstance(payload["sub"], str) or not ObjectId.is_valid(payload["sub"]):
+        raise jwt.InvalidTokenError("Invalid subject")
+    _token_cache[token] = payload
+    if len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+    return payload
+
+def serialize_user(user: dict) -> bytes:
+    """Serialize a user document (without password) for the Redis cache"""
+    cached = {k: v for k, v in user.items() if k != "password"}
+    cached["_id"] = str(cached["_id"])
+    return orjson.dumps(cached)
+
+def deserialize_user(raw: bytes) -> dict:
+    """Restore a cached user document to the shape returned by MongoDB"""
+    user = orjson.loads(raw)
+    user["_id"] = parse_object_id(user["_id"])
+    user["created_at"] = datetime.fromisoformat(user["created_at"])
+    return user
+
+async def cache_user(jti: str, user: dict, ttl: int) -> None:
+    """Cache the user document for the lifetime of the token"""
+    if ttl <= 0:
+        return
+    try:
+        user_sessions = f"auth:user:{user['_id']}"
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.setex(f"auth:{jti}", ttl, serialize_user(user))
+            pipe.sadd(user_sessions, jti)
+            pipe.expire(user_sessions, JWT_EXPIRATION_HOURS * 3600)
+            await pipe.execute()
+    except aioredis.RedisError as e:
+        print(f"⚠️  Redis cache write failed: {e}")
+
+async def get_cached_user(jti: str) -> Optional[dict]:
+    """Return the cached user document for a token, or None on miss"""
+    try:
+        raw = await redis.get(f"auth:{jti}")
+    except aioredis.RedisError as e:
+        print(f"⚠️  Redis cache read failed: {e}")
+        return None
+    return deserialize_user(raw) if raw else None
+
+async def invalidate_user_cache(user_oid: ObjectId, strict: bool = False) -> None:
+    """Drop every cached session of a user (strict=True raises Redis failures)"""
+    # Build keys from the ObjectId so they match the ones written by cache_user
+    user_id = str(user_oid)
+    try:
+        user_sessions = f"auth:user:{user_id}"
+        jtis = await redis.smembers(user_sessions)
+        keys = [f"auth:{jti.decode()}" for jti in jtis]
+        await redis.delete(user_sessions, f"qr:{user_id}", *keys)
+    except aioredis.RedisError as e:
+        if strict:
+            raise
+        print(f"⚠️  Redis cache invalidation failed: {e}")
+
+async def cache_qr_response(user_id: str, response: dict) -> None:
+    """Cache the serialized QR response for /qr/{user_id}"""
+    try:
+        await redis.setex(f"qr:{user_id}", QR_CACHE_TTL_SECONDS, orjson.dumps(response))
+    except aioredis.RedisError as e:
+        print(f"⚠️  Redis cache write failed: {e}")
+
+async def get_cached_qr_response(user_id: str) -> Optional[bytes]:
+    """Return the serialized QR response for a user, or None on miss"""
+    try:
+        return await redis.get(f"qr:{user_id}")
+    except aioredis.RedisError as e:
+        print(f"⚠️  Redis cache read failed: {e}")
+        return None
+
+@njit(cache=True, fastmath=False)
+def _penalty(mat: np.ndarray) -> int:
+    """Mask penalty score; same result as qrcode.util.lost_point"""
+    n = mat.shape[0]
+    penalty = 0
+
+    # Level 1: runs of five or more same-coloured modules
+    for i in range(n):
+        row_len = 1
+        col_len = 1
+        for j in range(1, n):
+            if mat[i, j] == mat[i, j - 1]:
+                row_len += 1
+            else:
+                if row_len >= 5:
+                    penalty += row_len - 2
+                row_len = 1
+            if mat[j, i] == mat[j - 1, i]:
+                col_len += 1
+            else:
+                if col_len >= 5:
+                    penalty += col_len - 2
+                col_len = 1
+        if row_len >= 5:
+            penalty += row_len - 2
+        if col_len >= 5:
+            penalty += col_len - 2
 
-def generate_qr_code(data: str) -> str:
-    """Generate QR code and return as base64 string"""
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    # Level 2: 2x2 blocks of the same colour
+    for i in range(n - 1):
+        for j in range(n - 1):
+            c = mat[i, j]
+            if c == mat[i, j + 1] and c == mat[i + 1, j] and c == mat[i + 1, j + 1]:
+                penalty += 3
+
+    # Level 3: 1:1:3:1:1 finder-like patterns with a 4-module light margin
+    for i in range(n):
+        for j in range(n - 10):
+            for k in range(2):
+                if k == 0:
+                    a = mat[i, j:j + 11]
+                else:
+                    a = mat[j:j + 11, i]
+                if (not a[1] and a[4] and not a[5] and a[6] and not a[9] and (
+                        a[0] and a[2] and a[3] and not a[7] and not a[8] and not a[10]
+                        or not a[0] and not a[2] and not a[3] and a[7] and a[8] and a[10])):
+                    penalty += 40
+
+    # Level 4: proportion of dark modules
+    dark_count = 0
+    for i in range(n):
+        for j in range(n):
+            dark_count += mat[i, j]
+    percent = dark_count / (n * n)
+    penalty += int(abs(percent * 100 - 50) / 5) * 10
+
+    return penalty
+
+def lost_point(modules) -> int:
+    """Drop-in replacement for qrcode.util.lost_point backed by _penalty"""
+    return _penalty(np.array(modules, dtype=np.uint8))
+
+# Mask selection scores all eight masks; route it through the JIT version
+qrcode.util.lost_point = lost_point
+
+@functools.lru_cache(maxsize=4096)
+def parse_object_id(user_id: str) -> ObjectId:
+    """Convert a user ID to an ObjectId, rejecting malformed IDs (memoized for recent IDs)"""
+    if not ObjectId.is_valid(user_id):
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    return ObjectId(user_id)
+
+async def migrate_legacy_qr_code(user: dict) -> dict:
+    """Move a base64 QR code stored on a user document into qr_codes"""
+    qr = {
+        "png": Binary(base64.b64decode(user["qr_code"])),
+        "data": f"USER:{user['_id']}|EMAIL:{user['email']}|ROLE:{user['role']}"
+    }
+    await qr_codes_qr_writes.update_one(
+        {"_id": user["_id"]},
+        {"$set": qr},
+        upsert=True
+    )
+    await users_qr_writes.update_one(
+        {"_id": user["_id"]},
+        {"$set": {"qr_data": qr["data"]}, "$unset": {"qr_code": ""}}
+    )
+    await invalidate_user_cache(user["_id"])
+    return qr
+
+def generate_qr_code(data: str) -> bytes:
+    """Generate QR code and return it as PNG bytes"""
+    # Payload is an opaque identifier, so low error correction is enough and
+    # keeps the symbol (and the Reed-Solomon/mask work) small
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=QR_BOX_SIZE,
+        border=QR_BORDER
+    )
     qr.add_data(data)
     qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
     
-    # Convert to base64
+    # Scale the module matrix (border included) straight into a 1-bit bitmap;
+    # set bits are white, dark modules are black
+    light = ~np.array(qr.get_matrix(), dtype=bool)
+    pixels = light.repeat(QR_BOX_SIZE, axis=0).repeat(QR_BOX_SIZE, axis=1)
+    img = Image.frombytes("1", pixels.shape[::-1], np.packbits(pixels, axis=1).tobytes())
+    
+    # Favour encode speed over size; the bitmap is highly repetitive anyway
     buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    img_str = base64.b64encode(buffer.getvalue()).decode()
-    return img_str
+    img.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Dependency to get current authenticated user"""
-    token = credentials.credentials
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication token")
-        
-        user = await users_collection.find_one({"_id": ObjectId(user_id)})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        return user
+        payload = decode_access_token(credentials.credentials)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid authentication token")
+    
+    jti = payload.get("jti")
+    if jti:
+        user = await get_cached_user(jti)
+        if user is not None:
+            return user
+    
+    user = await users_collection.find_one({"_id": parse_object_id(payload["sub"])}, projection=USER_PROJECTION)
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    if jti:
+        ttl = int(payload["exp"] - time.time())
+        await cache_user(jti, user, ttl)
+    
+    return user
 
 # Health Check Endpoint
-@app.get("/health/db")
-async def health_check():
-    """Check database connectivity"""
-    try:
-        await db.command('ping')
-        return {
+def db_health_body(error: Optional[str] = None) -> bytes:
+    """Serialize the health status, unhealthy when an error is given"""
+    if error is None:
+        return orjson.dumps({
             "status": "healthy",
             "database": "connected",
             "service": "User/Auth/QR Microservice"
-        }
+        })
+    return orjson.dumps({
+        "status": "unhealthy",
+        "database": "disconnected",
+        "error": error
+    })
+
+async def check_db_health() -> bytes:
+    """Ping the database and return the serialized health status"""
+    try:
+        await asyncio.wait_for(db.command('ping'), HEALTH_PING_INTERVAL_SECONDS)
+        return db_health_body()
+    except asyncio.TimeoutError:
+        return db_health_body("Database ping timed out")
     except Exception as e:
-        return {
-            "status": "unhealthy",
-            "database": "disconnected",
-            "error": str(e)
-        }
+        return db_health_body(str(e))
+
+# Latest health status and when it was measured (monotonic clock), refreshed in
+# the background so probes don't hit the database
+db_health: Optional[Tuple[float, bytes]] = None
+db_health_task: Optional[asyncio.Task] = None
+
+async def refresh_db_health():
+    """Re-check database connectivity every HEALTH_PING_INTERVAL_SECONDS"""
+    global db_health
+    while True:
+        ping = asyncio.ensure_future(db.command('ping'))
+        try:
+            await asyncio.wait_for(asyncio.shield(ping), HEALTH_PING_INTERVAL_SECONDS)
+            body = db_health_body()
+        except asyncio.TimeoutError:
+            db_health = (time.monotonic(), db_health_body("Database ping timed out"))
+            # Wait for the slow ping instead of stacking new ones on Motor's executor
+            try:
+                await ping
+                body = db_health_body()
+            except Exception as e:
+                body = db_health_body(str(e))
+        except Exception as e:
+            body = db_health_body(str(e))
+        db_health = (time.monotonic(), body)
+        await asyncio.sleep(HEALTH_PING_INTERVAL_SECONDS)
+
+@app.get("/health/db")
+async def health_check():
+    """Check database connectivity"""
+    if db_health is None:
+        body = await check_db_health()
+    elif time.monotonic() - db_health[0] > HEALTH_STALE_AFTER_SECONDS:
+        body = db_health_body("Health status is stale")
+    else:
+        body = db_health[1]
+    return Response(content=body, media_type="application/json")
+
+# The root response never changes, so serialize it once
+ROOT_BODY = orjson.dumps({
+    "message": "User/Auth/QR Microservice API",
+    "version": "1.0.0",
+    "docs": "/docs"
+})
+ROOT_ETAG = f'"{hashlib.blake2b(ROOT_BODY, digest_size=8).hexdigest()}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak If-None-Match comparison: handles "*", lists and W/ validators"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
 
 @app.get("/")
-async def root():
+async def root(request: Request):
     """Root endpoint"""
-    return {
-        "message": "User/Auth/QR Microservice API",
-        "version": "1.0.0",
-        "docs": "/docs"
-    }
+    if etag_matches(request.headers.get("if-none-match"), ROOT_ETAG):
+        return Response(status_code=304, headers={"ETag": ROOT_ETAG})
+    return Response(content=ROOT_BODY, media_type="application/json", headers={"ETag": ROOT_ETAG})
 
 # Authentication Endpoints
 @app.post("/auth/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
 async def register(user: UserCreate):
     """Register a new user"""
-    # Check if user already exists
-    existing_user = await users_collection.find_one({
-        "$or": [{"email": user.email}, {"username": user.username}]
-    })
-    
-    if existing_user:
-        raise HTTPException(
-            status_code=400,
-            detail="User with this email or username already exists"
-        )
-    
     # Create new user
     user_dict = {
         "username": user.username,
         "email": user.email,
-        "password": hash_password(user.password),
+        "password": await hash_password(user.password),
         "full_name": user.full_name,
         "role": user.role,
-        "created_at": datetime.utcnow(),
-        "qr_code": None
+        "created_at": datetime.utcnow()
     }
     
-    result = await users_collection.insert_one(user_dict)
+    # The unique email/username indexes reject existing users
+    try:
+        result = await users_collection.insert_one(user_dict)
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=400,
+            detail="User with this email or username already exists"
+        )
+    
     user_dict["id"] = str(result.inserted_id)
     user_dict.pop("password")
     user_dict.pop("_id", None)
@@ -185,59 +510,65 @@ async def register(user: UserCreate):
 @app.post("/auth/login", response_model=Token)
 async def login(user_login: UserLogin):
     """Login and get access token"""
-    user = await users_collection.find_one({"email": user_login.email})
+    user = await users_collection.find_one({"email": user_login.email}, projection=LOGIN_PROJECTION)
     
-    if not user or not verify_password(user_login.password, user["password"]):
+    if not user or not await verify_password(user_login.password, user["password"]):
         raise HTTPException(
             status_code=401,
             detail="Incorrect email or password"
         )
     
-    access_token = create_access_token(data={"sub": str(user["_id"]), "role": user["role"]})
+    jti = uuid.uuid4().hex
+    access_token = create_access_token(data={"sub": str(user["_id"]), "role": user["role"], "jti": jti})
+    await cache_user(jti, user, JWT_EXPIRATION_HOURS * 3600)
     
     return {"access_token": access_token, "token_type": "bearer"}
 
 # User Management Endpoints
-@app.get("/users/me", response_model=UserResponse)
+@app.get("/users/me", responses={200: {"model": UserResponse}})
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     """Get current authenticated user information"""
-    return {
+    return ORJSONResponse({
         "id": str(current_user["_id"]),
         "username": current_user["username"],
         "email": current_user["email"],
         "full_name": current_user.get("full_name"),
         "role": current_user["role"],
-        "created_at": current_user["created_at"],
-        "qr_code": current_user.get("qr_code")
-    }
+        "created_at": current_user["created_at"]
+    })
 
-@app.get("/users", response_model=List[UserResponse])
-async def get_all_users(current_user: dict = Depends(get_current_user)):
-    """Get all users (admin only)"""
+@app.get("/users", responses={200: {"model": List[UserResponse]}})
+async def get_all_users(
+    skip: int = Query(default=0, ge=0),
+    limit: int = Query(default=100, ge=1, le=1000),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get all users, paginated (admin only)"""
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Not authorized. Admin access required.")
     
-    users = []
-    async for user in users_collection.find():
-        users.append({
+    # Sort on _id so pages are stable between requests
+    cursor = users_collection.find({}, projection=USER_PROJECTION).sort("_id", 1).skip(skip).limit(limit)
+    cursor.batch_size(limit)
+    docs = await cursor.to_list(length=limit)
+    users = [
+        {
             "id": str(user["_id"]),
             "username": user["username"],
             "email": user["email"],
             "full_name": user.get("full_name"),
             "role": user["role"],
-            "created_at": user["created_at"],
-            "qr_code": user.get("qr_code")
-        })
+            "created_at": user["created_at"]
+        }
+        for user in docs
+    ]
     
-    return users
+    return ORJSONResponse(users)
 
-@app.get("/users/{user_id}", response_model=UserResponse)
+@app.get("/users/{user_id}", responses={200: {"model": UserResponse}})
 async def get_user_by_id(user_id: str, current_user: dict = Depends(get_current_user)):
     """Get user by ID"""
-    try:
-        user = await users_collection.find_one({"_id": ObjectId(user_id)})
-    except:
-        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    user = await users_collection.find_one({"_id": parse_object_id(user_id)}, projection=USER_PROJECTION)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -246,34 +577,44 @@ async def get_user_by_id(user_id: str, current_user: dict = Depends(get_current_
     if str(user["_id"]) != str(current_user["_id"]) and current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Not authorized to view this user")
     
-    return {
+    return ORJSONResponse({
         "id": str(user["_id"]),
         "username": user["username"],
         "email": user["email"],
         "full_name": user.get("full_name"),
         "role": user["role"],
-        "created_at": user["created_at"],
-        "qr_code": user.get("qr_code")
-    }
+        "created_at": user["created_at"]
+    })
 
 @app.delete("/users/{user_id}")
 async def delete_user(user_id: str, current_user: dict = Depends(get_current_user)):
     """Delete user (admin only or own account)"""
-    if current_user["role"] != "admin" and str(current_user["_id"]) != user_id:
+    oid = parse_object_id(user_id)
+    user_id = str(oid)
+    
+    if current_user["role"] != "admin" and oid != current_user["_id"]:
         raise HTTPException(status_code=403, detail="Not authorized to delete this user")
     
+    # Clear cached sessions first so a Redis outage fails the request before
+    # anything is deleted, rather than leaving the deleted user logged in
     try:
-        result = await users_collection.delete_one({"_id": ObjectId(user_id)})
-    except:
-        raise HTTPException(status_code=400, detail="Invalid user ID format")
+        await invalidate_user_cache(oid, strict=True)
+    except aioredis.RedisError:
+        raise HTTPException(status_code=503, detail="Session cache unavailable, try again later")
+    
+    result = await users_collection.delete_one({"_id": oid})
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
     
+    await qr_codes_collection.delete_one({"_id": oid})
+    # Drop sessions cached by requests that raced with the delete
+    await invalidate_user_cache(oid)
+    
     return {"message": "User deleted successfully", "user_id": user_id}
 
 # QR Code Endpoints
-@app.post("/qr/generate", response_model=QRCodeResponse)
+@app.post("/qr/generate", responses={200: {"model": QRCodeResponse}})
 async def generate_user_qr(current_user: dict = Depends(get_current_user)):
     """Generate QR code for current user"""
     user_id = str(current_user["_id"])
@@ -281,61 +622,122 @@ async def generate_user_qr(current_user: dict = Depends(get_current_user)):
     # Create QR code data (you can customize this)
     qr_data = f"USER:{user_id}|EMAIL:{current_user['email']}|ROLE:{current_user['role']}"
     
+    # Reuse the stored QR code if its payload has not changed
+    if current_user.get("qr_data") == qr_data:
+        cached = await get_cached_qr_response(user_id)
+        if cached:
+            return Response(content=cached, media_type="application/json")
+        
+        stored = await qr_codes_collection.find_one({"_id": current_user["_id"]})
+        if stored:
+            response = {
+                "user_id": user_id,
+                "qr_code_base64": base64.b64encode(stored["png"]).decode(),
+                "data": qr_data
+            }
+            await cache_qr_response(user_id, response)
+            return ORJSONResponse(response)
+    
     # Generate QR code
-    qr_code_base64 = generate_qr_code(qr_data)
+    png = generate_qr_code(qr_data)
     
-    # Update user with QR code
-    await users_collection.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"qr_code": qr_code_base64}}
+    # Store QR code image, then record its payload on the user
+    await qr_codes_qr_writes.update_one(
+        {"_id": current_user["_id"]},
+        {"$set": {"png": Binary(png), "data": qr_data}},
+        upsert=True
     )
+    await users_qr_writes.update_one(
+        {"_id": current_user["_id"]},
+        {"$set": {"qr_data": qr_data}, "$unset": {"qr_code": ""}}
+    )
+    await invalidate_user_cache(current_user["_id"])
     
-    return {
+    response = {
         "user_id": user_id,
-        "qr_code_base64": qr_code_base64,
+        "qr_code_base64": base64.b64encode(png).decode(),
         "data": qr_data
     }
+    await cache_qr_response(user_id, response)
+    
+    return ORJSONResponse(response)
 
-@app.get("/qr/{user_id}", response_model=QRCodeResponse)
+@app.get("/qr/{user_id}", responses={200: {"model": QRCodeResponse}})
 async def get_user_qr(user_id: str, current_user: dict = Depends(get_current_user)):
     """Get QR code for a specific user"""
-    try:
-        user = await users_collection.find_one({"_id": ObjectId(user_id)})
-    except:
-        raise HTTPException(status_code=400, detail="Invalid user ID format")
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    oid = parse_object_id(user_id)
+    # Canonical form, so cache keys match the ones cleared on regenerate/delete
+    user_id = str(oid)
     
     # Users can only view their own QR unless they're admin
-    if str(user["_id"]) != str(current_user["_id"]) and current_user["role"] != "admin":
+    if oid != current_user["_id"] and current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Not authorized to view this QR code")
     
-    if not user.get("qr_code"):
-        raise HTTPException(status_code=404, detail="QR code not generated for this user")
+    cached = await get_cached_qr_response(user_id)
+    if cached:
+        return Response(content=cached, media_type="application/json")
     
-    qr_data = f"USER:{user_id}|EMAIL:{user['email']}|ROLE:{user['role']}"
+    qr = await qr_codes_collection.find_one({"_id": oid})
+    if not qr:
+        user = await users_collection.find_one({"_id": oid}, projection={"email": 1, "role": 1, "qr_code": 1})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        if not user.get("qr_code"):
+            raise HTTPException(status_code=404, detail="QR code not generated for this user")
+        qr = await migrate_legacy_qr_code(user)
     
-    return {
+    response = {
         "user_id": user_id,
-        "qr_code_base64": user["qr_code"],
-        "data": qr_data
+        "qr_code_base64": base64.b64encode(qr["png"]).decode(),
+        "data": qr["data"]
     }
+    await cache_qr_response(user_id, response)
+    
+    return ORJSONResponse(response)
 
 # Startup event
 @app.on_event("startup")
 async def startup_db_client():
     """Create database indexes on startup"""
+    global bcrypt_pool, db_health_task
+    bcrypt_pool = create_bcrypt_pool()
+    db_health_task = asyncio.create_task(refresh_db_health())
+    loop = asyncio.get_running_loop()
+    print(f"🚀 Event loop: {type(loop).__module__}.{type(loop).__name__}")
+    # Start the bcrypt workers now; with forkserver they would otherwise spawn on the first login
+    await asyncio.gather(*(
+        loop.run_in_executor(bcrypt_pool, bcrypt.gensalt, 4) for _ in range(BCRYPT_WORKERS)
+    ))
+    # Compile the QR mask penalty now rather than on the first user request
+    _penalty(np.zeros((21, 21), dtype=np.uint8))
     try:
-        # Create unique indexes
+        # Create unique indexes; registration relies on them to reject duplicates
         await users_collection.create_index("email", unique=True)
         await users_collection.create_index("username", unique=True)
         print("✅ Database indexes created successfully")
     except Exception as e:
-        print(f"⚠️  Index creation warning: {e}")
+        print(f"❌ Unique index creation failed: {e}")
+        raise
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     """Close database connection on shutdown"""
+    if db_health_task is not None:
+        db_health_task.cancel()
     client.close()
-    print("🔌 Database connection closed")
\ No newline at end of file
+    await redis.aclose()
+    if bcrypt_pool is not None:
+        bcrypt_pool.shutdown()
+    print("🔌 Database connection closed")
+
+if __name__ == "__main__":
+    import uvicorn
+    
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=WEB_CONCURRENCY
+    )